@@ -3,9 +3,13 @@ def clockwork(duration):
 	def clock(method):
 		def wrapper(*args,**kwargs):
 			contingency = 0.001
-			start = time.time()
+			deadline = time.monotonic() + duration
 			result = method(*args,**kwargs)
-			while (time.time()-start) < (duration - contingency):
+			# Sleep through most of the remaining time, then spin the last ms
+			remaining = deadline - time.monotonic()
+			if remaining > 2*contingency:
+				time.sleep(remaining - contingency)
+			while time.monotonic() < deadline:
 				pass
 			return result
 		return wrapper
@@ -17,4 +21,4 @@ if __name__ == "__main__":
 		return x
 	start = time.time()
 	print(p(1))
-	print("Duration: {}".format(time.time()-start))
\ No newline at end of file
+	print("Duration: {}".format(time.time()-start))
@@ -16,10 +16,18 @@ Device parent class contains the following class variables:
                                   save, or update method
     _has_save_thread:   Boolean - whether device uses separate save thread
     _has_update_thread: Boolean - whether device uses separate update thread
-    _lock:              multiprocessing.Lock - lock used start/stop methods 
+    _lock:              threading.RLock - lock used start/stop methods 
+    _run_event:         threading.Event - set while device is running
+    _save_event:        threading.Event - set while data is allowed to save
+    _error_event:       threading.Event - set when an error has occurred,
+                                  checked by the update and save loops
+    _queue_capacity:    Integer - maximum number of items held in _data_queue
+    _on_overflow:       String  - "block" or "drop", what _put() does
+                                  when _data_queue is full
 
 Device parent class contains the following class properties:
-    ready(): Boolean - maps to self._open
+    ready(): Boolean - maps to self._open; child devices may also require
+             that no error is flagged (see Picoscope3207a.ready)
 
 Device parent class contains the following public class methods:
     open():             Opens the device
@@ -39,15 +47,20 @@ __maintainer__ = "Mitchell Black"
 __email__      = "mblack@michiganaerospace.com"
 __status__     = "Development"
 
-from multiprocessing import Lock
-from queue import Queue
-from threading import Thread
-from time import sleep,time
+from threading import Event,RLock,Thread
+from time import monotonic,sleep,time
 from os import mkdir
+from queue import Full
 import traceback
 import sys
 import datetime
 
+from spsc_queue import SPSCQueue
+
+# Module-level variables
+TRACEBACK_INTERVAL = 5 # seconds - minimum time between repeated tracebacks
+PUT_RETRY = 0.1 # seconds - how often a blocked _put() rechecks _allow_save
+
 ###############################################################################
 ############################### Class Definition ##############################
 ###############################################################################
@@ -66,12 +79,18 @@ class Device(object):
         self._allow_save = False
         self._has_error  = False
 
-        self._data_queue        = None # Queue for data
+        self._data_queue        = None # SPSCQueue from update to save thread
         self._has_save_thread   = None # Saves data placed into queue
         self._has_update_thread = None # Gets data and places it into queue
-        self._lock = Lock()
+        self._queue_capacity    = 4096 # Bound on _data_queue
+        self._on_overflow       = "block" # or "drop"
+        self._lock = RLock()
 
-        self._error_check_thread = Thread(target=self.check_error)
+        self._run_event   = Event() # Wakes update/save loops on start()
+        self._save_event  = Event() # Wakes save loop when saving is allowed
+        self._error_event = Event() # Set when an error occurs
+        self._last_tb_hash = None
+        self._last_tb_time = 0
 
     @property
     def ready(self):
@@ -93,11 +112,12 @@ class Device(object):
             self._open = self._open_device()
         except:
             self._has_error = True
+            self._error_event.set()
             traceback.print_exc(file=sys.stdout)
 
         if self._open:
             if self._has_save_thread or self._has_update_thread:
-                self._data_queue = Queue()
+                self._data_queue = SPSCQueue(self._queue_capacity)
 
             if self._has_save_thread:
                 self._save_thread = Thread(target=self.save,args=(self._data_queue,))
@@ -153,9 +173,11 @@ class Device(object):
                         self._running = self._start_device()
                     except:
                         self._has_error = True
+                        self._error_event.set()
                         traceback.print_exc(file=sys.stdout)
 
                     if self._running:
+                        self._run_event.set()
                         print("{} STARTED".format(self._name))
                     else:
                         print("{} DID NOT START".format(self._name))
@@ -177,6 +199,8 @@ class Device(object):
         with self._lock:
             self._running = False
             self._allow_save = False
+            self._run_event.clear()
+            self._save_event.clear()
             print("STOPPING {}".format(self._name))
             self._stop_device()
 
@@ -202,15 +226,26 @@ class Device(object):
         if not self._allow_save:
             self._create_log()
         self._allow_save = not self._allow_save
+        if self._allow_save:
+            self._save_event.set()
+        else:
+            self._save_event.clear()
         print("{} Allow Save: {}".format(self._name,self._allow_save))
 
-    def check_error(self):
-        while True:
-            if self._has_error:
-                print("{} has Error".format(self._name))
-                self._open = False
-                self._running = False
-                self._allow_save = False
+    def _maybe_handle_error(self):
+        """ Takes the device offline if an error has been flagged. Called at
+        the top of each update/save loop iteration.
+        Does not accept any arguments.
+        Does not return any values.
+        """
+        if self._error_event.is_set():
+            print("{} has Error".format(self._name))
+            self._open = False
+            self._running = False
+            self._allow_save = False
+            self._run_event.clear()
+            self._save_event.clear()
+            self._error_event.clear()
 
     def save(self,queue):
         """ Public method run on background self._save_thread. Does not need to
@@ -222,21 +257,42 @@ class Device(object):
         Does not return any values.
         """
         self._init_save()
-        while True: 
+        # Bound methods hoisted out of the loop; only the flags are re-read
+        run_wait = self._run_event.wait
+        save_wait = self._save_event.wait
+        handle_error = self._maybe_handle_error
+        save_data = self._save_data
+        drain = self._drain
+        while run_wait() and save_wait():
+            handle_error()
             if self._running and self._allow_save:
                 try:
-                    self._save_data(queue)
+                    save_data(drain(queue))
                 except:
                     self._has_error = True
-                    traceback.print_exc(file=sys.stdout)            
+                    self._error_event.set()
+                    if self._report_error():
+                        print("{} save stopped on repeated error".format(self._name))
+                        break
 
     def _init_save(self):
         """ Overwritten by child device."""
         print("_init_save")
 
-    def _save_data(params):
-        """ Overwritten by child device."""
-        print("Saved Parameters {}".format(params))
+    def _drain(self,queue,max_n=1024):
+        """ Blocks for one item, then takes whatever else is already waiting
+        in the queue (up to max_n items) without blocking.
+
+        queue: the SPSCQueue to be drained
+        max_n: maximum number of items returned in one batch
+
+        Returns a list of queued items, oldest first.
+        """
+        return queue.drain(max_n)
+
+    def _save_data(self,batch):
+        """ Overwritten by child device. batch is a list of queued items."""
+        print("Saved Parameters {}".format(batch))
         sleep(1)
 
     def update(self,queue):
@@ -248,19 +304,70 @@ class Device(object):
         queue: the data queue populated during device._get_update() 
         Does not return any values.
         """
-        while True:
+        # Bound methods hoisted out of the loop; only the flag is re-read
+        run_wait = self._run_event.wait
+        handle_error = self._maybe_handle_error
+        get_update = self._get_update
+        while run_wait():
+            handle_error()
             if self._running:
                 try:
-                    self._get_update(queue)
+                    get_update(queue)
                 except:
                     self._has_error = True
-                    traceback.print_exc(sys.stdout)
+                    self._error_event.set()
+                    if self._report_error():
+                        print("{} update stopped on repeated error".format(self._name))
+                        break
+
+    def _put(self,queue,item):
+        """ Adds item to the data queue from within _get_update. When the
+        queue is full, either waits for the save thread to catch up or, if
+        self._on_overflow is "drop", discards item; discarding the oldest
+        queued item instead would make this thread a second consumer of the
+        SPSCQueue. The save thread only drains the queue while saving is
+        allowed, so a blocked _put() also gives up and drops item once saving
+        is off (or if it never was), rather than stalling the update thread.
+
+        queue: the data queue passed to _get_update
+        item: the data to be saved
+        Does not return any values.
+        """
+        try:
+            queue.put_nowait(item)
+        except Full:
+            if self._on_overflow == "drop":
+                return
+            while self._allow_save:
+                try:
+                    queue.put(item,timeout=PUT_RETRY)
+                    return
+                except Full:
+                    pass
 
     def _get_update(self,queue):
-        """ Overwritten by child device."""
+        """ Overwritten by child device. Adds data with self._put(queue,x)."""
         print("Getting Update")
         sleep(1)
 
+    def _report_error(self):
+        """ Prints the traceback of the exception being handled unless it is
+        the same one printed less than TRACEBACK_INTERVAL seconds ago, so a
+        persistent error does not flood stdout. Called from an except block.
+        Does not accept any arguments.
+
+        Returns True if the traceback repeats the previous one.
+        """
+        tb = traceback.format_exc()
+        tb_hash = hash(tb)
+        now = monotonic()
+        repeated = tb_hash == self._last_tb_hash
+        if not repeated or now - self._last_tb_time > TRACEBACK_INTERVAL:
+            sys.stdout.write(tb)
+            self._last_tb_time = now
+        self._last_tb_hash = tb_hash
+        return repeated
+
     def _create_log(self):
         """ Overwritten by child device."""
         pass
@@ -5,12 +5,12 @@ import matplotlib
 matplotlib.use("TkAgg")
 from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg, NavigationToolbar2TkAgg
 from matplotlib.figure import Figure
-from matplotlib.pylab import xlim,ylim
 
 import tkinter as tk
 from tkinter import ttk
 from PIL import Image, ImageTk
-from threading import Thread
+from threading import Event,Thread
+from collections import deque
 from picoscope3207a import Picoscope3207a
 import numpy as np
 import matplotlib.pyplot as plt
@@ -18,6 +18,15 @@ import sys
 import traceback
 
 LARGE_FONT= ("Helvetica", 16)
+ICONS = {'start':   "images\\Start_Collection.gif",
+         'stop':    "images\\Stop_Collection.gif",
+         'collect': "images\\Collect_Block.gif",
+         'exit':    "images\\Exit.gif"}
+UI_TICK_MS = 33 # Tk redraw interval, decoupled from the acquisition rate
+FRAME_TIME = 0.5  # seconds between frames taken from the picoscope
+STATUS_TIME = 2.0 # seconds between Ready/Offline status updates
+PLOT_XLIM = (0,100E-6) # picoscope sampling duration (s)
+PLOT_YLIM = (-6,6)     # 5 V channel range plus 1 V margin
 
 def center(toplevel):
     toplevel.update_idletasks()
@@ -38,24 +47,25 @@ class PicoscopeGUI(tk.Frame):
         self._mouse_x = 0
         self._mouse_y = 0
         self._labels = {}
+        self._labels_state = {} # last (value, color) shown by each label
+        self._last_vals = {} # last raw (value, color) passed to set_field
+        self._last_x = None # (timebase, first time) of the x data on the lines
+
+        # Decode every button image once; keeping the dict on self stops the
+        # PhotoImages from being garbage collected (which blanks the buttons)
+        self._icons = {name: tk.PhotoImage(file=path) for name,path in ICONS.items()}
 
         # Run Continuously
-        photo = tk.PhotoImage(file="images\\Start_Collection.gif")
-        self._img = photo        
-        self._runloop_button = tk.Button(self,width=200,image=photo,borderwidth=0,highlightthickness=0,relief="flat",
+        self._runloop_button = tk.Button(self,width=200,image=self._icons['start'],borderwidth=0,highlightthickness=0,relief="flat",
         state='disabled',command=lambda: self.click_run_loop())
         self._runloop_button.grid(row=7,padx=0, columnspan=3,column=0,rowspan=1,sticky='nsew')
         
-        photo = tk.PhotoImage(file="images\\Collect_Block.gif")
-        self._img2 = photo
-        self._runonce_button = tk.Button(self,state='disabled',image=photo,borderwidth=0,highlightthickness=0,relief="flat",
+        self._runonce_button = tk.Button(self,state='disabled',image=self._icons['collect'],borderwidth=0,highlightthickness=0,relief="flat",
         command=lambda: self.click_run_once()) 
         self._runonce_button.grid(row=7,columnspan=3,column=3,rowspan=1,sticky='nsew')
        
-        photo = tk.PhotoImage(file="images\\Exit.gif")
-        self._exit_button = tk.Button(self,state='normal', image=photo,borderwidth=0,highlightthickness=0,relief="flat",
+        self._exit_button = tk.Button(self,state='normal', image=self._icons['exit'],borderwidth=0,highlightthickness=0,relief="flat",
         command=lambda: self.click_exit()) 
-        self._exit_button.img = photo
         self._exit_button.grid(row=7,columnspan=2,column=6,rowspan=1,sticky='nsew')
        
         image_frame = tk.Frame(self, height=400, width=300,bg='black')
@@ -72,14 +82,18 @@ class PicoscopeGUI(tk.Frame):
         self.a = f.add_subplot(111)
         # self.a.set_adjustable('box-forced')
         self.a.axis('off')
-        self.a.autoscale(True)
+        # Limits stay fixed so the cached background stays valid for blitting
+        self.a.set_xlim(*PLOT_XLIM)
+        self.a.set_ylim(*PLOT_YLIM)
         f.subplots_adjust(left=0,right=1,bottom=0,top=1)
-        data = {'time':np.linspace(0,100E-6,100),'data':np.array([np.linspace(-2,2,100),np.linspace(-0.5,0.5,100)]).reshape(100,2)}
+        # One column per channel; reshape(100,2) of a (2,100) array would
+        # interleave the two channels sample by sample
+        data = {'time':np.linspace(0,100E-6,100),'data':np.column_stack((np.linspace(-2,2,100),np.linspace(-0.5,0.5,100)))}
         self.plot = self.a.plot('time','data',data=data) # timedata is 1D array, data is 2D array
         # self.plot = self.a.imshow(initial_data,origin='lower')
         
         for p in self.plot:
-            p.axes.axis('tight')
+            p.set_animated(True)
         # self.plot.axes.axis('tight')
         self.f = f
         
@@ -93,6 +107,8 @@ class PicoscopeGUI(tk.Frame):
         widget.grid(row=0,column=0,columnspan=5,rowspan=6)
         #widget.pack()
         self.canvas = canvas
+        self.canvas.mpl_connect('draw_event', self._on_draw)
+        self._on_draw(None)
         #toolbar = NavigationToolbar2TkAgg(canvas, self)
         #toolbar.update()
         #canvas._tkcanvas.pack(side=tk.TOP, fill=tk.BOTH, expand=True)
@@ -104,16 +120,28 @@ class PicoscopeGUI(tk.Frame):
         #self.canvas.mpl_connect('figure_enter_event', self.figure_enter)
         #self.canvas.mpl_connect('figure_leave_event', self.figure_leave)
 
-        t = Thread(target=self.update,args=())
+        # Latest frames from the picoscope, filled by the _poll_device thread
+        # and drawn by _ui_tick on the Tk main loop
+        self._frame_ring = deque(maxlen=4)
+        self._frame_event = Event()
+        self._buttons_enabled = False
+        self._next_status = time.monotonic() + STATUS_TIME
+
+        t = Thread(target=self._poll_device,args=())
         t.daemon = True
         t.start()
+        self.after(UI_TICK_MS,self._ui_tick)
         return
 
     def set_label(self,name,value,color='white'):
-        if name in self._labels.keys():
-            self._labels[name].config(text="{}".format(value),fg = color)
+        if self._labels_state.get(name) == (value,color):
+            return # unchanged, skip the Tk reconfigure
+        self._labels_state[name] = (value,color)
+        label = self._labels.get(name)
+        if label is not None:
+            label.config(text="{}".format(value),fg = color)
         else:
-            idx = len(self._labels.keys())
+            idx = len(self._labels)
             label_title = tk.Label(self._image_frame,  text="{}:".format(name), font=LARGE_FONT, bg='black', fg='white')
             label_title.grid(row=idx,padx=10,column=0,columnspan=2, sticky='e')
         
@@ -121,9 +149,19 @@ class PicoscopeGUI(tk.Frame):
             label_value.grid(row=idx,column=2,columnspan=1)
             self._labels[name] = label_value
         
+    def set_field(self,name,raw,unit,color='white'):
+        """ Shows a numeric value with its unit in the named label. Skips
+        formatting entirely when raw and color match the last call.
+        """
+        if self._last_vals.get(name) == (raw,color):
+            return
+        self._last_vals[name] = (raw,color)
+        self.set_label(name,f"{raw} {unit}",color)
+
     def click_exit(self):
+        self._run = False # stops the _poll_device thread
         self._picoscope.close()
-        sys.exit()
+        self.after(0,sys.exit)
     
     def button_press(self,event):
         x = event.x/500.0*600.0
@@ -146,8 +184,11 @@ class PicoscopeGUI(tk.Frame):
     def click_run_once(self):
         self._picoscope.run_once()
         
-    def update(self):
-        update_time = time.time()
+    def _poll_device(self):
+        """ Target of the background thread. Opens and starts the picoscope,
+        then snapshots its latest data into self._frame_ring. Makes no Tk
+        calls; those are left to _ui_tick on the main thread.
+        """
         # #self._laser = hardware.Laser()
         # #image = Image.open("Start_Laser.png")
         self._picoscope.open()
@@ -156,56 +197,82 @@ class PicoscopeGUI(tk.Frame):
 
         self._picoscope.start()
 
-        start_collection = tk.PhotoImage(file="images\\Start_Collection.gif")
-        stop_collection = tk.PhotoImage(file="images\\Stop_Collection.gif")
-        
-        self._runloop_button.config(state='normal')
-        self._runonce_button.config(state='normal')
-            
+        next_frame = time.monotonic()
         while(self._run):
-            if not self._picoscope._collecting:
-                self._runloop_button.config(image=start_collection)
+            pico = self._picoscope
+            # Copies from one block; the picoscope rewrites its buffers in place
+            t,channel_data = pico.snapshot()
+            frame = (t,channel_data,pico.timebase,
+                     pico.data1,pico.data2,pico.data3,
+                     pico._collecting,pico.ready)
+            self._frame_ring.append(frame)
+            self._frame_event.set()
+            next_frame += FRAME_TIME
+            time.sleep(max(0,next_frame - time.monotonic()))
+
+    def _on_draw(self,event):
+        """ Caches the static background after every full canvas draw (the
+        animated lines are excluded from it) and repaints the lines on top.
+        """
+        self._bg = self.canvas.copy_from_bbox(self.a.bbox)
+        self._blit()
+
+    def _blit(self):
+        """ Repaints only the plot lines over the cached background. """
+        self.canvas.restore_region(self._bg)
+        for p in self.plot:
+            self.a.draw_artist(p)
+        self.canvas.blit(self.a.bbox)
+
+    def _ui_tick(self):
+        """ Scheduled on the Tk main loop with after(). Draws the newest frame
+        in self._frame_ring, if any, and re-arms itself.
+        """
+        if self._frame_event.is_set():
+            self._frame_event.clear()
+            t,channel_data,timebase,data1,data2,data3,collecting,ready = self._frame_ring[-1]
+
+            if not self._buttons_enabled:
+                self._runloop_button.config(state='normal')
+                self._runonce_button.config(state='normal')
+                self._buttons_enabled = True
+
+            if not collecting:
+                self._runloop_button.config(image=self._icons['start'])
             else:
-                self._runloop_button.config(image=stop_collection) 
+                self._runloop_button.config(image=self._icons['stop'])
 
-            self.set_label("Chan A Max","{} V".format(self._picoscope.data1),"green")
-            self.set_label("Data Field 2","{} Units".format(self._picoscope.data2),"green")
-            self.set_label("Data Field 3","{} Units".format(self._picoscope.data3),"green")
-            
-            if time.time() - update_time > 2: # Only update this every 2 seconds
-                update_time = time.time()
-                if self._picoscope.ready:
+            self.set_field("Chan A Max",data1,"V","green")
+            self.set_field("Data Field 2",data2,"Units","green")
+            self.set_field("Data Field 3",data3,"Units","green")
+
+            if time.monotonic() >= self._next_status: # Only update this every 2 seconds
+                self._next_status += STATUS_TIME
+                if ready:
                     self.set_label("Picoscope","Ready","green")
                 else:
                     self.set_label("Picoscope","Offline","red")
 
             try:
-                for chan,i in zip(self.plot,range(2)):
-                    chan.set_data(self._picoscope.t,self._picoscope.channel_data[i])
-                    xlim(min(self._picoscope.t),max(self._picoscope.t))
-                    ylim(min(self._picoscope.channel_data[i])-1,max(self._picoscope.channel_data[i])+1)
-                    # rescale
-                # self.plot.set_data(self._picoscope.data) 
-                # shape = self._picoscope.image.shape
-                # max_w = self._picoscope._camera._settings.roiWidth
-                # max_h = self._picoscope._camera._settings.roiHeight
-                # x = min(int(self._mouse_x/500.0*max_w),max_w)
-                # y =  min(int(self._mouse_y/500.0*max_h),max_h)
-                # #self._label_val.config(text = "{}".format(self._picoscope.image[y,x]))
-                # self.set_label("Pixel Count","{}".format(self._picoscope.image[y,x]))
-                # self.set_label("X,Y","({},{})".format(x,y))
-                self.canvas.draw()
+                # t is the time template shifted by the block's trigger
+                # offset, so the timebase and its first sample identify it;
+                # x is only reset when either changes
+                x = (timebase,t[0])
+                if x != self._last_x:
+                    self._last_x = x
+                    for chan in self.plot:
+                        chan.set_xdata(t)
+                for i,chan in enumerate(self.plot):
+                    chan.set_ydata(channel_data[i])
+                self._blit()
             except:
                 traceback.print_exc(file=sys.stdout)
+                self._run = False
                 self.destroy()
-                break
-            time.sleep(.5)
-            #self.n += 1
-            #data = [[1,2,3,4,5,6,7,8],[5,6,1,self.n,8,9,3,5]]
-            #self.plot.set_data(data) 
-            #self.canvas.draw()
-            #time.sleep(.5)
-        
+                return
+
+        self.after(UI_TICK_MS,self._ui_tick)
+
 
 class UI(tk.Tk):    
     def __init__(self, *args, **kwargs):
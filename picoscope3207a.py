@@ -3,7 +3,8 @@ Picoscope3207a Class.
 
 This file contains the framework for the Picoscope3207a class. It makes calls
 to the Picotech 3000a API in order to communicate with the Picoscope. The class
-includes methods to collect data and save it in a csv form. Running this script
+includes methods to collect data and save it in raw binary or csv form (see
+SAVE_FORMAT; raw_to_csv.py converts saved binary runs). Running this script
 will instantiate the class, open the device, collect data in 100us blocks for 
 5 seconds, save it, and then close.
 
@@ -15,13 +16,14 @@ Device parent class contains the following class variables:
     _allow_save:        Boolean - whether data to be collected will be saved
     _has_error:         Boolean - whether error has occurred in open, start,
                                   save, or update method
-    _data_queue:        queue.Queue - Queue for data
+    _data_queue:        SPSCQueue - bounded queue from update to save thread
     _has_save_thread:   Boolean - whether device uses separate save thread
     _has_update_thread: Boolean - whether device uses separate update thread
-    _lock:              multiprocessing.Lock - lock used start/stop methods 
+    _lock:              threading.RLock - lock used start/stop methods 
 
 Device parent class contains the following class properties:
-    ready(): Boolean - maps to self._open
+    ready(): Boolean - self._open; Picoscope3207a also requires that no
+             error is flagged (self._has_error) by the last block
 
 Device parent class contains the following public class methods:
     open():             Opens the device
@@ -30,7 +32,6 @@ Device parent class contains the following public class methods:
     stop():             Stops updating and saving methods
     restart():          Calls close() and open() with a delay in between
     toggle_save():      Toggles the boolean value _allow_save
-    check_error():      Sets  _open, _running, _allow_save to False if error
     save():             Runs _save_device method on a background thread
     update():           Runs _update_device method on a background thread
 """
@@ -46,27 +47,78 @@ __status__     = "Beta"
 import traceback
 import sys
 import numpy as np
-import inspect
 import time
 import csv
 import datetime
+import json
+import logging
 
 from ctypes import *
-from multiprocessing import Lock
-from queue import Queue
-from threading import Thread
-from math import log
+from multiprocessing import Lock,Process,Queue
+from multiprocessing.shared_memory import SharedMemory
+from queue import Empty
+from threading import Event,Thread
 
 from device import Device
-from clockwork import clockwork
+from spsc_queue import SPSCQueue
 from error_codes import ERROR_CODES
 
 # Module-level variables
+logger = logging.getLogger(__name__)
 LOOP_FREQ = 1 # Hz
 LOOP_TIME = 1 / LOOP_FREQ
 MAX_EXT = 32767
 TRIGGER_ON = 1
 TRIGGER_OFF = 0
+READY_TIMEOUT = 5 # seconds to wait for a block (autotrigger fires after 2 s)
+PICO_CANCELLED = 0x3A # block status when the capture was stopped
+RING_SLOTS = 8 # preallocated frames cycling between collect and save
+SAVE_BATCH_BLOCKS = 64 # blocks buffered by save() before each file write
+SAVE_BATCH_TIME = 0.05 # seconds a partial batch may wait before it is written
+SAVE_BUFFER = 8 << 20 # bytes buffered per save file; flushed when full or on stop
+SAVE_FORMAT = "raw" # "raw": int16 blocks + json sidecar, "csv": text in volts
+CSV_FMT = '%.7g' # csv number format; 7 digits resolve every ADC count
+CSV_TILE_ROWS = 4096 # csv rows formatted per write, bounds the text buffer
+SAVE_PROCESS = False # save in a separate process attached to the frame ring
+THREAD_PRIORITY_HIGHEST = 2 # Windows priority of the collect thread
+HIGH_PRIORITY_CLASS = 0x80 # Windows priority class of the whole process
+# Windows core masks; collect and save stay on different cores and off core 0
+COLLECT_AFFINITY = 0x2
+SAVE_AFFINITY = 0x4
+
+# void ps3000aBlockReady(int16_t handle, PICO_STATUS status, void *pParameter)
+CALLBACK_FACTORY = WINFUNCTYPE if sys.platform == "win32" else CFUNCTYPE
+BLOCK_READY = CALLBACK_FACTORY(None, c_int16, c_uint32, c_void_p)
+
+# Prototypes of the ps3000a functions used below, applied once in
+# _open_device so calls can pass plain Python ints. Every call returns a
+# PICO_STATUS (uint32).
+API_ARGTYPES = {
+    "ps3000aOpenUnit":               [POINTER(c_int16), c_char_p],
+    "ps3000aChangePowerSource":      [c_int16, c_uint32],
+    "ps3000aCloseUnit":              [c_int16],
+    "ps3000aStop":                   [c_int16],
+    "ps3000aSetChannel":             [c_int16, c_int32, c_int16, c_int32,
+                                      c_int32, c_float],
+    "ps3000aSetSimpleTrigger":       [c_int16, c_int16, c_int32, c_int16,
+                                      c_int32, c_uint32, c_int16],
+    "ps3000aSetSigGenBuiltIn":       [c_int16, c_int32, c_uint32, c_int16,
+                                      c_float, c_float, c_float, c_float,
+                                      c_int32, c_int32, c_uint32, c_uint32,
+                                      c_int32, c_int32, c_int16],
+    "ps3000aSigGenSoftwareControl":  [c_int16, c_int16],
+    "ps3000aMemorySegments":         [c_int16, c_uint32, POINTER(c_int32)],
+    "ps3000aSetDataBuffer":          [c_int16, c_int32, POINTER(c_int16),
+                                      c_int32, c_uint32, c_int32],
+    "ps3000aRunBlock":               [c_int16, c_int32, c_int32, c_uint32,
+                                      c_int16, POINTER(c_int32), c_uint32,
+                                      BLOCK_READY, c_void_p],
+    "ps3000aGetValues":              [c_int16, c_uint32, POINTER(c_uint32),
+                                      c_uint32, c_int32, c_uint32,
+                                      POINTER(c_int16)],
+    "ps3000aGetTriggerTimeOffset64": [c_int16, POINTER(c_int64),
+                                      POINTER(c_int32), c_uint32]}
+
 CHANNEL_RANGE = [\
                 {"rangeV": 20E-3,  "apivalue": 1,  "rangeStr": "20 mV"},
                 {"rangeV": 50E-3,  "apivalue": 2,  "rangeStr": "50 mV"},
@@ -78,6 +130,24 @@ CHANNEL_RANGE = [\
                 {"rangeV": 5.0,    "apivalue": 8,  "rangeStr": "5 V"},
                 {"rangeV": 10.0,   "apivalue": 9,  "rangeStr": "10 V"},
                 {"rangeV": 20.0,   "apivalue": 10, "rangeStr": "20 V"}]
+RANGE_BY_V = {r["rangeV"]: r for r in CHANNEL_RANGE}
+
+# PICO_STATUS code -> name/description, for check_result
+ERROR_NAMES = {t[0]: t[1] for t in ERROR_CODES}
+ERROR_DESCS = {t[0]: (t[2] if len(t) > 2 else "") for t in ERROR_CODES}
+V_RANGE = 5.0 # V, input range of both channels
+
+# PS3000A_THRESHOLD_DIRECTION values
+TRIGGER_DIRECTION = {"Above":0, "Below":1, "Rising":2, "Falling":3,
+                     "RiseOrFall":4}
+
+# Built-in waveforms and software trigger settings of the AWG
+WAVE_TYPE = {'sine':0, 'square':1, 'triangle':2, 'DC':3,
+             'rising sawtooth':4, 'falling sawtooth':5, 'sin(x)/x':6,
+             'Gaussian':7, 'half-sine':8}
+SIGGEN_TRIGGER_TYPE = {'rising':0, 'falling':1, 'gate high':2, 'gate low':3}
+SIGGEN_TRIGGER_SOURCE = {'none':0, 'scope trig':1, 'aux in':2, 'ext in':3,
+                         'soft trig':4}
 
 class Picoscope3207a(Device):
     """ Picoscope3207a inherits from the Device class """
@@ -85,9 +155,9 @@ class Picoscope3207a(Device):
     def __init__(self):
         """ Initializes the class properties used throughout the Picoscope3207a
         class. Uses two locks, one for the run method and one for calls to the 
-        API. Also instantiates two queue.Queue's, one to send data to the 
-        process thread and one to transfer post-processed data to the save 
-        thread. 
+        API. Also instantiates the queue that transfers processed frame slots
+        from the collect thread to the save thread (an SPSCQueue, or a
+        multiprocessing.Queue when saving in a separate process).
 
         Does not accept any arguments.
 
@@ -104,42 +174,96 @@ class Picoscope3207a(Device):
         self._sampling_time = 1E-6
         self._sampling_duration = 100E-6
         self._samples = int(self._sampling_duration / self._sampling_time)
+        self._timebase = self.get_timebase(self._sampling_time)
         self._idx = 0
         
-        self._A_data = np.ones(100)*2
-        self._B_data = np.ones(100)*-2
-        self._t = np.linspace(0,100E-6,100)
+        # Latest block, allocated once and overwritten in place by run()
+        self._channel_data = np.empty((2,self._samples),dtype=np.float32)
+        self._channel_data[0] = 2
+        self._channel_data[1] = -2
+        self._t = np.linspace(0,self._sampling_duration,self._samples)
+        # Sample times relative to the trigger; run() only adds the offset
+        self._time_template = np.linspace(0,self._sampling_duration,self._samples)
+        # Bumped before and after run() rewrites _t/_channel_data, so it is
+        # odd while they are being written; see snapshot()
+        self._block_seq = 0
         self.distance = None
-
-        self._process_queue = Queue()
-        self._save_queue = Queue()
+        # Per-channel summary of the latest processed block, in volts
+        self.v_max = self._channel_data.max(axis=1).astype(float)
+        self.v_min = self._channel_data.min(axis=1).astype(float)
+        self.v_rms = np.sqrt(np.mean(self._channel_data**2,axis=1)).astype(float)
+        self._counts = np.empty(2,dtype=np.int16) # scratch for _process
+        self._sum_sq = np.empty(2)
+
+        # Frame slot indices passed from collect to save; the frames
+        # themselves are preallocated
+        self._save_queue = Queue(RING_SLOTS) if SAVE_PROCESS else SPSCQueue(RING_SLOTS)
+        self._ring_shm = None
+        self._ring_unlinked = False
+
+        # RunBlock completion callback; kept on self so it is not GC'd
+        self._ready_event = Event()
+        self._ready_status = 0
+        self._ready_cb = BLOCK_READY(self._block_ready)
+
+        # Set by stop() to cut short run_loop()'s pacing wait
+        self._stop_event = Event()
+
+        # Pipeline threads, started by the first start() and kept across
+        # stop()/start() since they idle on _run_event and the queues
+        self._save_thread = None
+        self._collect_thread = None
+
+        # Out-parameters of the per-block API calls and pointers to them,
+        # allocated once and passed as is to the prototyped functions
+        self._time_indisposed_ms = c_int32()
+        self._n_samples = c_uint32(self._samples)
+        self._overflow = c_int16()
+        self._trigger_time = c_int64()
+        self._trigger_time_units = c_int32()
+        self._p_time_indisposed_ms = pointer(self._time_indisposed_ms)
+        self._p_n_samples = pointer(self._n_samples)
+        self._p_overflow = pointer(self._overflow)
+        self._p_trigger_time = pointer(self._trigger_time)
+        self._p_trigger_time_units = pointer(self._trigger_time_units)
 
     def _open_device(self):
         """ Called by the parent Device class during the open() method. Loads 
-        the API functions and establishes communication to the picoscope via 
-        the OpenUnit API function. Also switches the power source to USB Power 
-        if necessary.
+        the API functions, sets their argument types from API_ARGTYPES, and
+        establishes communication to the picoscope via the OpenUnit API
+        function. Also switches the power source to USB Power 
+        if necessary. On Windows the process is raised to HIGH_PRIORITY_CLASS
+        and the system timer to 1 ms resolution for the pacing sleeps.
 
         Does not accept any arguments.
 
         Returns True if successful.
         """
         self._lib = windll.LoadLibrary("lib\\ps3000a.dll")
+        if sys.platform == "win32":
+            kernel32 = windll.kernel32
+            kernel32.GetCurrentProcess.restype = c_void_p
+            kernel32.SetPriorityClass(c_void_p(kernel32.GetCurrentProcess()),
+                HIGH_PRIORITY_CLASS)
+            windll.winmm.timeBeginPeriod(1) # 1 ms sleep granularity
+        for name,argtypes in API_ARGTYPES.items():
+            func = getattr(self._lib,name)
+            func.argtypes = argtypes
+            func.restype = c_uint32
         c_handle = c_int16()
         with self._driver_lock:
             m = self._lib.ps3000aOpenUnit(byref(c_handle),None)
             if m == 286:
-                m = self._lib.ps3000aChangePowerSource(c_handle,
-                    c_int32(m))
+                m = self._lib.ps3000aChangePowerSource(c_handle,m)
         check_result(m)
-        self._handle = c_handle
+        self._handle = c_handle.value
 
         return True
 
     def _close_device(self):
         """ Called by the parent Device class during the close() method. 
         Disconnects from the picoscope via a call to the CloseUnit API 
-        function.
+        function, and unlinks the frame ring's shared memory name.
 
         Does not accept any arguments.
 
@@ -148,6 +272,14 @@ class Picoscope3207a(Device):
         with self._driver_lock:
             m = self._lib.ps3000aCloseUnit(self._handle)
         check_result(m)
+        if sys.platform == "win32":
+            windll.winmm.timeEndPeriod(1)
+        if self._ring_shm is not None and not self._ring_unlinked:
+            # Drops the name only. self._ring_shm keeps the ring mapped for
+            # the collect/save threads and driver buffers, which outlive
+            # close() and are reused by the next open()/start()
+            self._ring_shm.unlink()
+            self._ring_unlinked = True
 
     def _start_device(self):
         """ Called by the parent Device class during the start() method. 
@@ -155,112 +287,180 @@ class Picoscope3207a(Device):
         input channels, sets the Trigger, and sets the memory locations. Sets
         the Arbitrary Waveform Generator to output a square wave of 40 kHz.
 
-        Also responsible for starting the save, process, and collect threads in
-        coordination with their respective queues.
+        Also responsible for allocating the frame ring and starting the save
+        and collect threads, which share the save queue. Both happen once; a
+        restart reuses the running threads.
 
         Does not accept any arguments.
 
         Returns True if successful.
         """
-        self._data = [np.empty(self._samples,dtype=np.int16) for i in range(2)]
-        self._data_buffer = [x.ctypes for x in self._data]
-        self._timebase = self.get_timebase(self._sampling_time)
-        self.v_rangeAPI = CHANNEL_RANGE[7]["apivalue"] # 5V range
-        self.v_range = CHANNEL_RANGE[7]["rangeV"]
+        self._stop_event.clear()
+        if self._ring_shm is None: # kept if a failed start() is retried
+            # Ring of preallocated frames: raw ADC counts for both channels
+            # plus trigger offsets. run() fills a free slot, save() hands it
+            # back.
+            # The ADC counts and trigger offsets live in shared memory so a
+            # save process can read them without copies.
+            self._ring_shm = SharedMemory(create=True,size=ring_nbytes(self._samples))
+            self._ring_data,self._ring_offset = ring_views(self._ring_shm.buf,self._samples)
+            # ctypes views of each slot's channel buffers, handed straight
+            # to SetDataBuffer; the memory is kept alive by self._ring_shm
+            buffer_type = c_int16 * self._samples
+            self._ring_buffers = [[buffer_type.from_address(x.ctypes.data) for x in frame]
+                                  for frame in self._ring_data]
+            self._free_slots = Queue(RING_SLOTS) if SAVE_PROCESS else SPSCQueue(RING_SLOTS)
+            for slot in range(RING_SLOTS):
+                self._free_slots.put(slot)
+        self.v_rangeAPI = RANGE_BY_V[V_RANGE]["apivalue"]
+        self.v_range = V_RANGE
+        self._scale_f = self.v_range / MAX_EXT # volts per ADC count
         with self._driver_lock:
             for i in range(2):  # two active channels
                 m = self._lib.ps3000aSetChannel(self._handle,
-                    c_int32(i), # channel
-                    c_int16(1), # enabled
-                    c_int32(1), # DC coupling
-                    c_int32(self.v_rangeAPI), 
-                    c_float(0)) # 0V offset
-                check_result(m)
-
-                m = self._lib.ps3000aSetDataBuffer(self._handle,
-                    c_int32(i),  # channel
-                    self._data_buffer[i],
-                    c_int32(self._samples),
-                    c_uint32(0), # segment index
-                    c_int32(0))  # ratio mode
+                    i, # channel
+                    1, # enabled
+                    1, # DC coupling
+                    self.v_rangeAPI,
+                    0) # 0V offset
                 check_result(m)
 
             threshold_v = 0.1
             threshold_adc = int(threshold_v * MAX_EXT / self.v_range)
             m = self._lib.ps3000aSetSimpleTrigger(self._handle,
-                c_int16(1),    # enabled
-                c_int32(4),    # EXT trigger
-                c_int16(threshold_adc),
-                c_int32(2),    # direction = rising
-                c_uint32(0),   # no delay
-                c_int16(2000)) # autotrigger after 1 second if no trigger occurs
+                1,    # enabled
+                4,    # EXT trigger
+                threshold_adc,
+                TRIGGER_DIRECTION["Rising"],
+                0,    # no delay
+                2000) # autotrigger after 1 second if no trigger occurs
+            check_result(m)
+
+            # One memory segment per ring slot, each with that slot's buffers
+            # registered once, so a block only needs RunBlock/GetValues with
+            # the slot as segment index
+            max_samples = c_int32()
+            m = self._lib.ps3000aMemorySegments(self._handle,
+                RING_SLOTS,
+                byref(max_samples)) # samples available per segment
             check_result(m)
+            if max_samples.value < self._samples:
+                raise IOError("{} segments hold {} samples, {} needed".format(
+                    RING_SLOTS,max_samples.value,self._samples))
+            for slot,frame in enumerate(self._ring_buffers):
+                for i in range(2):
+                    m = self._lib.ps3000aSetDataBuffer(self._handle,
+                        i,  # channel
+                        frame[i],
+                        self._samples,
+                        slot, # segment index
+                        0)  # ratio mode
+                    check_result(m)
 
             # Send AWG Info to Picoscope
             output_freq = 40E3 # 40 kHz
             offset_voltage = 0
             pk2pk = 4
-            wave_type = {'sine':0,'square':1,'triangle':2,'DC':3,
-                         'rising sawtooth':4,'falling sawtooth':5,'sin(x)/x':6,
-                         'Gaussian':7,'half-sine':8}
-            trigger_type = 2 # siggen gate high
-            trigger_source = 4 # software trigger
             m = self._lib.ps3000aSetSigGenBuiltIn(self._handle,
-                c_int32(int(offset_voltage*1E6)), # offset voltage
-                c_uint32(int(pk2pk*1E6)),# peak to peak voltage
-                c_int32(wave_type['square']), # wave type
-                c_float(output_freq), # start frequency
-                c_float(output_freq), # stop frequency
-                c_float(0), # increment
-                c_float(0), # dwell count
-                c_int32(0), # sweep type
-                c_int32(0), # operation
-                c_uint32(4), # shots
-                c_uint32(0), # sweeps
-                c_int32(trigger_type), 
-                c_int32(trigger_source),
-                c_int16(0)) # extIn threshold
+                int(offset_voltage*1E6), # offset voltage
+                int(pk2pk*1E6),# peak to peak voltage
+                WAVE_TYPE['square'], # wave type
+                output_freq, # start frequency
+                output_freq, # stop frequency
+                0, # increment
+                0, # dwell count
+                0, # sweep type
+                0, # operation
+                4, # shots
+                0, # sweeps
+                SIGGEN_TRIGGER_TYPE['gate high'],
+                SIGGEN_TRIGGER_SOURCE['soft trig'],
+                0) # extIn threshold
             check_result(m)
 
-        self._save_thread = Thread(target=self.save,args=(self._save_queue,))
-        self._save_thread.daemon = True
-        self._save_thread.start()
+        if self._collect_thread is None:
+            if SAVE_PROCESS:
+                self._save_thread = Process(target=save_process,
+                    args=(self._save_queue,self._free_slots,
+                          self._ring_shm.name,self._run_meta()))
+            else:
+                self._save_thread = Thread(target=self.save,args=(self._save_queue,))
+            self._save_thread.daemon = True
+            self._save_thread.start()
 
-        self._process_thread = Thread(target=self.process,args=(self._process_queue,self._save_queue))
-        self._process_thread.daemon = True
-        self._process_thread.start()
-
-        self._collect_thread = Thread(target=self.run_loop,args=(self._process_queue,))
-        self._collect_thread.daemon = True
-        self._collect_thread.start()
+            self._collect_thread = Thread(target=self.run_loop,args=(self._save_queue,))
+            self._collect_thread.daemon = True
+            self._collect_thread.start()
 
         return True
 
     def _stop_device(self):
         """ Called by the parent Device class during the stop() method. Stops 
-        collection mode via call to Stop API function.
+        collection mode via call to Stop API function, cancels a block that
+        run() may be waiting for, and has the save side close its files.
 
         Does not accept any arguments.
 
         Does not return any values.
         """
-        with self._driver_lock:
-            m = self._lib.ps3000aStop(self._handle)
-        check_result(m)
+        try:
+            with self._driver_lock:
+                try:
+                    m = self._lib.ps3000aStop(self._handle)
+                finally:
+                    # Set with the driver lock held so _acquire() either sees
+                    # it before RunBlock or has its RunBlock cancelled by
+                    # this Stop
+                    self._stop_event.set()
+            check_result(m)
+        finally:
+            # Even if Stop failed: release run() and close the run's files
+            self._ready_status = PICO_CANCELLED
+            self._ready_event.set()
+            # Once run() has let go of the cancelled block, tell the save
+            # side to write out its partial batch and close the files
+            with self._run_lock:
+                self._save_queue.put(None)
 
     def run_loop(self,queue):
         """ Target of the _collect_thread. Makes calls to the run() method to 
-        acquire data.
+        acquire data, one every LOOP_TIME seconds. A block that fails sets
+        _has_error until one succeeds, without ending the thread, since it is
+        only started once. The wait between blocks ends early on stop(), so
+        the thread goes straight back to idling on _run_event instead of
+        finishing its sleep. On Windows the thread runs
+        at THREAD_PRIORITY_HIGHEST on the COLLECT_AFFINITY cores so block
+        acquisition is not preempted by the save and UI threads.
 
-        queue: queue.Queue() - self._process_queue to which data is added.
+        queue: SPSCQueue - self._save_queue to which data is added.
 
         Does not return any values.
         """
-        while True:
-            if self._running:
-                with self._run_lock:
+        set_current_thread(COLLECT_AFFINITY,THREAD_PRIORITY_HIGHEST)
+        next_t = None
+        while self._run_event.wait(): # sleeps until start()
+            if next_t is None:
+                next_t = time.monotonic() # first block since start()
+            with self._run_lock:
+                try:
                     self.run(queue)
-            time.sleep(0.001) # allow lock to be freed
+                    self._has_error = False
+                    self._error_event.clear()
+                except:
+                    # e.g. a READY_TIMEOUT or driver error: flag it (ready goes
+                    # False) and keep the thread alive to retry the next block
+                    self._has_error = True
+                    self._error_event.set()
+                    self._report_error()
+            next_t += LOOP_TIME
+            delay = next_t - time.monotonic()
+            if delay > 0:
+                # Also lets run_once() take the lock; returns early on stop()
+                self._stop_event.wait(delay)
+            else:
+                next_t = time.monotonic() # fell behind
+            if self._stop_event.is_set():
+                next_t = None # pace afresh from the next start()
 
     def run_once(self):
         """ Makes one call to the run() method.
@@ -270,177 +470,261 @@ class Picoscope3207a(Device):
         Does not return any values.
         """
         with self._run_lock:
-            self.run(self._process_queue,True) # True: override flag for saving
+            # True: save even when not collecting; False: also capture after
+            # stop(), e.g. from the Collect Block button
+            self.run(self._save_queue,True,False)
 
-    @clockwork(LOOP_TIME) # forces method below to execute in LOOP_TIME seconds
-    def run(self,queue,override=False):
+    def run(self,queue,override=False,stoppable=True):
         """ Called to acquire data in Block mode. The following algorithm is 
-        implemented: RunBlock -> SoftwareTriggerOn -> IsReady? -> GetValues ->
-        GetTriggerTimeOffsets -> SoftwareTriggerOff -> add data to 
-        _process_queue.
-
-        queue: queue.Queue() - self._process_queue to which data is added for
-               processing
-        override: flag for save() method - save if run_once() method is called
+        implemented: SetDataBuffer -> RunBlock -> SoftwareTriggerOn -> 
+        BlockReady -> GetValues -> GetTriggerTimeOffsets -> SoftwareTriggerOff
+        -> _process -> add frame slot to _save_queue. The block is captured
+        straight into a free slot of the preallocated frame ring and processed
+        on this thread while it is still in cache.
+
+        queue: SPSCQueue - self._save_queue to which the slot is added for
+               saving
+        override: flag for save() method - save even when not collecting,
+                  set when run_once() method is called
+        stoppable: skip the block if stop() has been called (run_loop());
+                   cleared by run_once(), which captures while stopped too
 
         Does not return any values.
         """
         # if self._idx == 0:
         #     self._start_time = time.time()
-        time_indisposed_ms = c_int32()
-        ready = c_int16(0)
+        slot = self._free_slots.get()
+        # Slots are only ever handed back by the save side, which is the sole
+        # producer of _free_slots; unused ones go to it marked not to save
+        try:
+            acquired = self._acquire(slot,stoppable)
+            if acquired:
+                self._process(self._ring_data[slot])
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug("Block max %.3f V, time indisposed %d ms",
+                        self.v_max[0],self._time_indisposed_ms.value)
+        except:
+            queue.put((slot,False))
+            raise
+        if not acquired: # cancelled by stop()
+            queue.put((slot,False))
+            return
+
+        # Place frame into queue, flagged with whether it is to be saved
+        queue.put((slot,override or self._collecting))
+        # self._idx += 1
+
+    def _acquire(self,slot,stoppable=True):
+        """ Captures one block into frame slot of the ring and updates the
+        latest-block buffers read by the UI.
+
+        slot: index of a free frame in self._ring_data/self._ring_offset
+        stoppable: return False without capturing once stop() has been called
+
+        Returns False if the block was cancelled by stop(), else True.
+        """
+        raw = self._ring_data[slot]
+        self._ready_event.clear()
         with self._driver_lock:
-            # Start Run
+            if stoppable and self._stop_event.is_set():
+                return False # stop() landed before the event was cleared
+            # Start Run into the slot's segment (buffers set in start())
             m = self._lib.ps3000aRunBlock(self._handle,
-                c_int32(0), # pretrigger samples
-                c_int32(self._samples), # postrigger samples
-                c_uint32(self._timebase),
-                c_int16(0), # overflow - not used
-                byref(time_indisposed_ms), # time spent collecting data
-                c_uint32(0), # segment index
-                c_void_p(),
-                c_void_p())
+                0, # pretrigger samples
+                self._samples, # postrigger samples
+                self._timebase,
+                0, # overflow - not used
+                self._p_time_indisposed_ms, # time spent collecting data
+                slot, # segment index
+                self._ready_cb, # called by the driver when data is ready
+                None)
             check_result(m)
 
             # Trigger AWG
-            m = self._lib.ps3000aSigGenSoftwareControl(self._handle,c_int16(TRIGGER_ON))
+            m = self._lib.ps3000aSigGenSoftwareControl(self._handle,TRIGGER_ON)
             check_result(m)
 
-            # Wait for picoscope
-            while ready.value == 0:
-                m = self._lib.ps3000aIsReady(self._handle,byref(ready))
-                check_result(m)
+        # Wait for picoscope without holding the driver lock
+        if not self._ready_event.wait(READY_TIMEOUT):
+            with self._driver_lock:
+                self._lib.ps3000aStop(self._handle) # abandon the block
+            raise IOError("Timed out waiting for {} block".format(self._name))
+        if self._ready_status == PICO_CANCELLED:
+            return False
+        check_result(self._ready_status)
 
+        with self._driver_lock:
             # Get Data
-            n_samples = c_uint32(); n_samples.value = self._samples
-            overflow = c_int16()
-            for i in range(2):
-                start = i*self._samples
-                m = self._lib.ps3000aGetValues(self._handle,
-                    c_uint32(start), # start index
-                    byref(n_samples),
-                    c_uint32(1),     # downsample ratio
-                    c_int32(0),      # downsample ratio mode
-                    c_uint32(0),     # segment index
-                    byref(overflow)) # flags if channel has gone over voltage
-                check_result(m)
+            # One transfer fills both channel buffers of the slot's segment
+            self._n_samples.value = self._samples # overwritten by driver
+            m = self._lib.ps3000aGetValues(self._handle,
+                0, # start index
+                self._p_n_samples,
+                1, # downsample ratio
+                0, # downsample ratio mode
+                slot, # segment index
+                self._p_overflow) # flags if channel has gone over voltage
+            check_result(m)
 
             # Get Trigger Offset
-            times = c_int64()
-            time_units = c_int32()
             m = self._lib.ps3000aGetTriggerTimeOffset64(self._handle,
-                byref(times),      # offset time
-                byref(time_units), # offset time unit
-                c_uint32(0))       # segment index
+                self._p_trigger_time,       # offset time
+                self._p_trigger_time_units, # offset time unit
+                slot)                       # segment index
             check_result(m)
 
             # Re-arm AWG Trigger
-            m = self._lib.ps3000aSigGenSoftwareControl(self._handle,c_int32(TRIGGER_OFF))
+            m = self._lib.ps3000aSigGenSoftwareControl(self._handle,TRIGGER_OFF)
             check_result(m)
 
-        offset_time = times.value * 10**(-15+3*time_units.value)
+        offset_time = self._trigger_time.value * 10**(-15+3*self._trigger_time_units.value)
+        self._ring_offset[slot] = offset_time
 
-        time_indisposed_s = time_indisposed_ms.value/1000
+        time_indisposed_s = self._time_indisposed_ms.value/1000
         time_indisposed_s = 0 # To Do: Determine what to do with this
 
+        self._block_seq += 1 # odd: latest-block buffers being rewritten
+
         # Questionable Tactic
+        time_data = self._t # written in place, like channel_data
         if time_indisposed_s > 0:
-            time_data = np.linspace(0,time_indisposed_s,self._samples) + offset_time
+            np.multiply(self._time_template,
+                time_indisposed_s/self._sampling_duration,out=time_data)
+            time_data += offset_time
         else:
-            time_data = np.linspace(0,self._sampling_duration,self._samples) + offset_time
+            np.add(self._time_template,offset_time,out=time_data)
 
-        data = np.array(self._data) * self.v_range / MAX_EXT
-        self._A_data = np.array(data[0])
-        self._B_data = np.array(data[1])
-        self._t = time_data
-        print(max(data[0]))
-
-        # Place data into queue
-        queue.put((time_data,data,override))
-        # self._idx += 1
+        self._scale(raw,self._channel_data)
+        self._block_seq += 1
+        return True
 
-    def process(self,get_queue,put_queue):
-        """ Target of _process_thread. Processes the raw data collected from
-        the picoscope.
+    def _scale(self,raw,out):
+        """ Converts raw ADC counts to volts in a single vectorized pass.
 
-        get_queue: queue.Queue() - self._process_queue from which data is taken
-        put_queue: queue.Queue() - self._save_queue to which data is added 
-                   for saving
+        raw: np.int16 array of ADC counts from the picoscope
+        out: preallocated np.float32 array the same shape as raw, overwritten
 
         Does not return any values.
         """
-        # idx = 0
+        np.multiply(raw,self._scale_f,out=out,dtype=np.float32)
 
-        while True:
-            try:
-                t,v,override = get_queue.get()
+    def _block_ready(self,handle,status,parameter):
+        """ ps3000aBlockReady callback passed to RunBlock. Runs on a driver
+        thread once the block has been captured and wakes run().
+        """
+        self._ready_status = status
+        self._ready_event.set()
 
-                # do something to process data
-                self.distance = v[0][1]
+    def _process(self,raw):
+        """ Called by run() on the collect thread right after a block is
+        acquired. Computes the per-channel max, min and rms of the block. Each
+        is a single vectorized pass over the int16 ADC counts, scaled to volts
+        only once per channel.
 
+        raw: (2, samples) np.int16 array of ADC counts
 
-                put_queue.put((t,v,override))
-            except:
-                traceback.print_exc(file=sys.stdout)
-            # idx += 1
+        Does not return any values.
+        """
+        scale = self._scale_f
+        counts = self._counts
+        sum_sq = self._sum_sq
+        np.multiply(raw.max(axis=1,out=counts),scale,out=self.v_max)
+        np.multiply(raw.min(axis=1,out=counts),scale,out=self.v_min)
+        np.einsum('ij,ij->i',raw,raw,dtype=np.float64,out=sum_sq)
+        np.sqrt(np.divide(sum_sq,self._samples,out=sum_sq),out=sum_sq)
+        np.multiply(sum_sq,scale,out=self.v_rms)
+        self.distance = raw[0,1] * scale
 
     def save(self,queue):
-        """ Target of _save_thread. Saves the processed data to a csv file.
+        """ Target of _save_thread. Saves the blocks collected by run() to
+        disk via save_blocks(). Not used with SAVE_PROCESS, where
+        save_process() runs in its own process instead.
 
-        queue: queue.Queue() - self._save_queue from which data is taken
+        queue: SPSCQueue - self._save_queue from which slots are taken
 
         Does not return any values.
         """
-        filename = "data\\" + datetime.datetime.utcnow().strftime('%Y%m%d_%H%M%S') + ".csv"
-        idx = 0
+        set_current_thread(SAVE_AFFINITY)
+        save_blocks(queue,self._free_slots,self._ring_data,self._ring_offset,
+            self._run_meta())
 
-        while True:
-            try:
-                times,voltages,override = queue.get()
-
-                # save in csv
-                if self._collecting or override:
-                    if idx == 0:
-                        with open(filename,'w',newline='') as csvfile:
-                            writer = csv.writer(csvfile,delimiter=',')
-                            writer.writerow(["Time (sec)","Channel A (V)","Channel B (V)"])
-                    with open(filename,'a',newline='') as csvfile:
-                        writer = csv.writer(csvfile,delimiter=',')
-                        for t,v1,v2 in zip(times,voltages[0],voltages[1]):
-                            writer.writerow([str(t),str(v1),str(v2)])
-                
-            except:
-                traceback.print_exc(file=sys.stdout)
-
-            idx += 1
+    def _run_meta(self):
+        """ Describes the runs save_blocks() writes: format, and the sampling
+        and scaling needed to interpret the saved ADC counts. Each run's file
+        names are added by stamp_run() when its first block is written. For
+        SAVE_FORMAT "raw" this is written out as the run's json sidecar.
+
+        Does not accept any arguments.
+
+        Returns the description as a dict.
+        """
+        meta = {"format":            SAVE_FORMAT,
+                "samples":           self._samples,
+                "channels":          ["Channel A","Channel B"],
+                "dtype":             "int16",
+                "layout":            "blocks x channels x samples",
+                "sampling_time":     self._sampling_time,
+                "sampling_duration": self._sampling_duration,
+                "v_range":           self.v_range,
+                "volts_per_count":   self._scale_f}
+        return meta
 
     def get_timebase(self,dt):
         """ Converts a delta_t (sampling time) into a timebase readable by the
-        picoscope.
+        picoscope. For the 3207A timebases 0-2 sample every 2^n ns and higher
+        timebases every (n-2)/125 MHz. Called once, from __init__.
 
         dt: sampling time
 
         returns n: timebase
         """
-        if dt > 4E-9:
-            n = int(dt*125E6 + 2)
+        dt_ns = int(round(dt*1E9))
+        if dt_ns > 4:
+            n = int(round(dt*125E6)) + 2
         else:
-            dt *= 1E9
-            n = round(log(dt,2))
+            n = max(dt_ns,1).bit_length() - 1 # 1, 2, 4 ns -> 0, 1, 2
         return n
 
+    @property
+    def ready(self):
+        """ Open, and the last block (if any) was acquired without error. """
+        return self._open and not self._has_error
+
     @property
     def t(self):
         return self._t
 
+    @property
+    def timebase(self):
+        """ Picoscope timebase; t only changes spacing when this does """
+        return self._timebase
+
     @property
     def channel_data(self): 
-        return self._A_data,self._B_data
+        """ (2, samples) array of the latest block, updated in place """
+        return self._channel_data
+
+    def snapshot(self):
+        """ Copies the latest block for a reader on another thread, such as
+        pico_ui.py. t and channel_data are rewritten in place by run(), so the
+        copy is retried until both come from the same, complete block.
+
+        Does not accept any arguments.
+
+        Returns (t, channel_data) copies.
+        """
+        while True:
+            seq = self._block_seq
+            t = self._t.copy()
+            channel_data = self._channel_data.copy()
+            if seq % 2 == 0 and seq == self._block_seq:
+                return t,channel_data
+            time.sleep(0) # let run() finish the block
 
     @property
     def data1(self):
         """ This is read by the pico_ui.py script """ 
-        return round(max(self._A_data),3)
+        return round(float(self.v_max[0]),3)
 
     @property
     def data2(self):
@@ -462,29 +746,201 @@ def check_result(ec):
     # Some of the newer scopes, can actually be powered by USB and will
     # return a useful value. That should be given back to the user.
     # I guess we can deal with these edge cases in the functions themselves
-    if ec == 0:
+    if not ec:
         return
 
     else:
         ecName = error_num_to_name(ec)
         ecDesc = error_num_to_desc(ec)
         raise IOError('Error calling %s: %s (%s)' % (
-            str(inspect.stack()[1][3]), ecName, ecDesc))
+            sys._getframe(1).f_code.co_name, ecName, ecDesc))
 
 def error_num_to_name(num):
     """Return the name of the error as a string."""
-    for t in ERROR_CODES:
-        if t[0] == num:
-            return t[1]
+    return ERROR_NAMES.get(num,"UNKNOWN")
 
 def error_num_to_desc(num):
     """Return the description of the error as a string."""
-    for t in ERROR_CODES:
-        if t[0] == num:
-            try:
-                return t[2]
-            except IndexError:
-                return ""
+    return ERROR_DESCS.get(num,"")
+
+def set_current_thread(affinity,priority=None):
+    """Pin the calling thread to the cores in the affinity mask and, if
+    given, set its priority. Does nothing outside Windows."""
+    if sys.platform != "win32":
+        return
+    kernel32 = windll.kernel32
+    kernel32.GetCurrentThread.restype = c_void_p
+    thread = c_void_p(kernel32.GetCurrentThread())
+    kernel32.SetThreadAffinityMask(thread,c_size_t(affinity))
+    if priority is not None:
+        kernel32.SetThreadPriority(thread,priority)
+
+def ring_nbytes(samples):
+    """Return the size in bytes of the shared frame ring."""
+    return RING_SLOTS*8 + RING_SLOTS*2*samples*2
+
+def ring_views(buf,samples):
+    """Return (ADC counts, trigger offsets) numpy views of a frame ring
+    buffer: (RING_SLOTS, 2, samples) int16 and (RING_SLOTS,) float64."""
+    offsets = np.ndarray((RING_SLOTS,),dtype=np.float64,buffer=buf)
+    data = np.ndarray((RING_SLOTS,2,samples),dtype=np.int16,buffer=buf,
+        offset=offsets.nbytes)
+    return data,offsets
+
+def save_process(queue,free_slots,shm_name,meta):
+    """Target of the save process with SAVE_PROCESS. Attaches to the frame
+    ring by its shared memory name and runs save_blocks() on it."""
+    set_current_thread(SAVE_AFFINITY)
+    shm = SharedMemory(name=shm_name)
+    ring_data,ring_offset = ring_views(shm.buf,meta["samples"])
+    save_blocks(queue,free_slots,ring_data,ring_offset,meta)
+
+def get_many(queue,max_n,timeout=None):
+    """Return a list of up to max_n items from queue, waiting up to timeout
+    seconds for the first as in get() and taking the rest only if they are
+    already waiting. An SPSCQueue hands them over in one drain() call; a
+    multiprocessing Queue is read item by item. Raises queue.Empty if nothing
+    arrived."""
+    if isinstance(queue,SPSCQueue):
+        return queue.drain(max_n,timeout=timeout)
+    items = [queue.get(timeout=timeout)]
+    try:
+        while len(items) < max_n:
+            items.append(queue.get_nowait())
+    except Empty:
+        pass
+    return items
+
+def save_blocks(queue,free_slots,ring_data,ring_offset,meta):
+    """Save the blocks run() puts on queue in the run's format. Blocks are
+    copied out of the frame ring into a preallocated batch (so their slots
+    go straight back to run()) and written once SAVE_BATCH_BLOCKS have
+    arrived or the oldest has waited SAVE_BATCH_TIME seconds. The output
+    files of a run are named by stamp_run() and opened at its first write,
+    buffered in SAVE_BUFFER bytes with no per-batch flush, and kept open
+    until a None on the queue (sent by stop()) flushes and closes them; the
+    next write after that starts a new run with new files.
+
+    "raw" appends the int16 ADC counts as they come off the device to a
+    .bin file and each block's trigger offset to a float64 .offsets.bin
+    file, described by a json sidecar. "csv" writes time and volts rows.
+
+    queue: (slot, save) pairs from run(), where unsaved slots are only handed
+           back, or None to close the files. Everything waiting is taken
+           at once with get_many().
+    free_slots: queue to which slots are handed back to run()
+    ring_data, ring_offset: the frame ring, as returned by ring_views()
+    meta: run description from Picoscope3207a._run_meta(), without file
+          names
+    """
+    samples = meta["samples"]
+    template = np.linspace(0,meta["sampling_duration"],samples)
+    files = None
+    blocks = np.empty((SAVE_BATCH_BLOCKS,2,samples),dtype=np.int16)
+    offsets = np.empty(SAVE_BATCH_BLOCKS)
+    n_blocks = 0
+    deadline = 0
+
+    while True:
+        timeout = max(0,deadline - time.monotonic()) if n_blocks else None
+        try:
+            items = get_many(queue,SAVE_BATCH_BLOCKS - n_blocks,timeout)
+        except Empty:
+            items = [()] # nothing arrived; only check the deadline
+
+        for item in items:
+            closing = item is None
+
+            if item:
+                slot,keep = item
+                if keep:
+                    blocks[n_blocks] = ring_data[slot]
+                    offsets[n_blocks] = ring_offset[slot]
+                    if n_blocks == 0:
+                        deadline = time.monotonic() + SAVE_BATCH_TIME
+                    n_blocks += 1
+                free_slots.put(slot) # hand the frame back to run()
+
+            if n_blocks and (closing or n_blocks == SAVE_BATCH_BLOCKS or
+                             time.monotonic() >= deadline):
+                try:
+                    if files is None:
+                        files = open_save_files(meta)
+                    if meta["format"] == "raw":
+                        # write() goes through the SAVE_BUFFER buffer;
+                        # ndarray.tofile() would flush it and write directly
+                        files[0].write(memoryview(blocks[:n_blocks]))
+                        files[1].write(memoryview(offsets[:n_blocks]))
+                    else:
+                        write_csv(files[0],blocks[:n_blocks],offsets[:n_blocks],
+                            template,meta["volts_per_count"])
+                except:
+                    traceback.print_exc(file=sys.stdout)
+                n_blocks = 0
+
+            if closing and files is not None:
+                for f in files:
+                    f.close()
+                files = None
+
+def stamp_run(meta,n=0):
+    """Return a copy of meta with the file names of a new run, stamped with
+    the current UTC time and, for n > 0, suffixed with _n."""
+    filename = "data\\" + datetime.datetime.utcnow().strftime('%Y%m%d_%H%M%S')
+    if n:
+        filename += "_{}".format(n)
+    run = dict(meta)
+    if meta["format"] == "raw":
+        run["sidecar"] = filename + ".json"
+        run["data"] = filename + ".bin"
+        run["offset_time"] = filename + ".offsets.bin"
+    else:
+        run["data"] = filename + ".csv"
+    return run
+
+def open_save_files(meta):
+    """Create the files of a new run, named by stamp_run(), for save_blocks()
+    to write to, along with the json sidecar or csv header. The data file is
+    created exclusively, so a run started within the same second as the last
+    one gets the next _n suffix instead of appending to it. Returns a tuple
+    of the open files: (data, offsets) for "raw", (csvfile,) for "csv"."""
+    n = 0
+    while True:
+        run = stamp_run(meta,n)
+        try:
+            if meta["format"] == "raw":
+                data = open(run["data"],'xb',buffering=SAVE_BUFFER)
+            else:
+                data = open(run["data"],'x',newline='',buffering=SAVE_BUFFER)
+            break
+        except FileExistsError:
+            n += 1
+
+    if meta["format"] == "raw":
+        with open(run["sidecar"],'w') as f:
+            json.dump(run,f,indent=4)
+        return (data,open(run["offset_time"],'wb',buffering=SAVE_BUFFER))
+    else:
+        writer = csv.writer(data,delimiter=',')
+        writer.writerow(["Time (sec)","Channel A (V)","Channel B (V)"])
+        return (data,)
+
+def write_csv(csvfile,blocks,offsets,template,scale):
+    """Write (n, channels, samples) int16 blocks as csv rows of time
+    (template plus each block's trigger offset) and every channel in volts.
+    Whole blocks are formatted in tiles of about CSV_TILE_ROWS rows, each by
+    one %-operation on a repeated row template and a single write call, so
+    the numbers and text of a large batch are never all held at once."""
+    n,n_channels,samples = blocks.shape
+    tile = max(1,CSV_TILE_ROWS // samples) # blocks per tile
+    rows = np.empty((min(n,tile),samples,n_channels+1))
+    row = ','.join([CSV_FMT]*(n_channels+1)) + '\n'
+    for i in range(0,n,tile):
+        b = blocks[i:i+tile]
+        r = rows[:len(b)]
+        np.add(template,offsets[i:i+tile,None],out=r[:,:,0])
+        np.multiply(b.transpose(0,2,1),scale,out=r[:,:,1:])
+        csvfile.write((row*r[:,:,0].size) % tuple(r.ravel().tolist()))
 
 ###############################################################################
 #################################### Main #####################################
@@ -0,0 +1,63 @@
+"""
+Raw To CSV Converter.
+
+This file converts a run saved by Picoscope3207a in the "raw" SAVE_FORMAT into
+the csv layout used by the "csv" format (time, Channel A and Channel B in
+volts). The run is described by its json sidecar, which names the int16 data
+file and the float64 trigger offset file and holds the scaling needed to turn
+ADC counts into volts. Conversion is done offline, a batch of blocks at a time,
+so the save thread never has to format text.
+
+Usage:
+    python raw_to_csv.py data\\20180101_120000.json [out.csv]
+"""
+
+import csv
+import json
+import sys
+import numpy as np
+
+from picoscope3207a import write_csv
+
+# Module-level variables
+CONVERT_BATCH_BLOCKS = 256 # blocks formatted per write call
+
+def raw_to_csv(sidecar,csv_path=None):
+    """ Converts one raw run to csv.
+
+    sidecar: path of the run's json sidecar
+    csv_path: output path, defaults to the sidecar path with a .csv extension
+
+    Returns the number of blocks converted.
+    """
+    with open(sidecar) as f:
+        meta = json.load(f)
+    if csv_path is None:
+        csv_path = sidecar.rsplit('.',1)[0] + ".csv"
+
+    samples = meta["samples"]
+    n_channels = len(meta["channels"])
+    offsets = np.fromfile(meta["offset_time"],dtype=np.float64)
+    blocks = np.memmap(meta["data"],dtype=meta["dtype"],mode='r')
+    # The two files are flushed independently, so during a run or after a
+    # crash one may hold more blocks than the other; convert those in both
+    n_blocks = min(len(offsets),len(blocks) // (n_channels*samples))
+    offsets = offsets[:n_blocks]
+    blocks = blocks[:n_blocks*n_channels*samples].reshape(n_blocks,n_channels,samples)
+    template = np.linspace(0,meta["sampling_duration"],samples)
+
+    with open(csv_path,'w',newline='',buffering=1<<20) as csvfile:
+        writer = csv.writer(csvfile,delimiter=',')
+        writer.writerow(["Time (sec)"] + ["{} (V)".format(c) for c in meta["channels"]])
+        for i in range(0,len(offsets),CONVERT_BATCH_BLOCKS):
+            write_csv(csvfile,blocks[i:i+CONVERT_BATCH_BLOCKS],
+                offsets[i:i+CONVERT_BATCH_BLOCKS],template,meta["volts_per_count"])
+
+    return len(offsets)
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print(__doc__)
+        sys.exit(1)
+    n = raw_to_csv(*sys.argv[1:3])
+    print("Converted {} blocks".format(n))
@@ -0,0 +1,140 @@
+"""
+Single-Producer Single-Consumer Queue.
+
+This file contains a small bounded FIFO for passing data from exactly one
+producer thread to exactly one consumer thread, e.g. a device's update thread
+and save thread. It is a Lamport ring: a preallocated list of slots indexed by
+a head counter that only the consumer advances and a tail counter that only
+the producer advances. Each side only reads the other's counter, so put() and
+get() take no lock while there is room or data; this relies on the GIL to make
+the slot store and the counter update visible in program order.
+
+A threading.Condition is used only to sleep: a side that finds the ring full
+(producer) or empty (consumer) flags itself as waiting and blocks on it, and
+the other side notifies it only when that flag is set.
+
+The interface follows queue.Queue (put/get/put_nowait/get_nowait, raising
+queue.Full and queue.Empty) with the addition of drain(), which hands the
+consumer everything that is waiting in a single call.
+"""
+
+from queue import Empty,Full
+from threading import Condition,Lock
+
+class SPSCQueue(object):
+    """ Bounded FIFO for one producer thread and one consumer thread. """
+
+    def __init__(self,capacity=4096):
+        """ capacity: maximum number of queued items before put() blocks. """
+        self._capacity = capacity
+        size = 1 << max(capacity - 1,0).bit_length() # next power of two
+        self._slots = [None] * size
+        self._mask = size - 1
+        self._head = 0 # next slot to read, advanced only by the consumer
+        self._tail = 0 # next slot to write, advanced only by the producer
+        self._cond = Condition(Lock())
+        self._put_waiting = False # producer is (about to be) asleep on full
+        self._get_waiting = False # consumer is (about to be) asleep on empty
+
+    def __len__(self):
+        return self._tail - self._head
+
+    @property
+    def capacity(self):
+        return self._capacity
+
+    def qsize(self):
+        return self._tail - self._head
+
+    def empty(self):
+        return self._tail == self._head
+
+    def full(self):
+        return self._tail - self._head >= self._capacity
+
+    def _wait(self,ready,timeout,flag):
+        """ Sleeps until ready() is true or timeout seconds pass. The waiting
+        flag (attribute name) is set before ready() is first checked, so an
+        update made by the other side either satisfies that check or sees the
+        flag and notifies. Each side has its own flag so one side waking up
+        cannot clear the other's.
+
+        Returns the last value of ready().
+        """
+        with self._cond:
+            setattr(self,flag,True)
+            try:
+                return self._cond.wait_for(ready,timeout)
+            finally:
+                setattr(self,flag,False)
+
+    def _wake(self):
+        """ Wakes the other side. Only called when its flag is set. """
+        with self._cond:
+            self._cond.notify()
+
+    def put(self,item,block=True,timeout=None):
+        """ Adds item to the queue. If the queue is full, waits for the
+        consumer (up to timeout seconds) unless block is False.
+
+        Raises queue.Full if no room became available.
+        """
+        tail = self._tail
+        if tail - self._head >= self._capacity:
+            if not block or not self._wait(
+                    lambda: self._tail - self._head < self._capacity,timeout,
+                    '_put_waiting'):
+                raise Full
+        self._slots[tail & self._mask] = item
+        self._tail = tail + 1 # publishes the item
+        if self._get_waiting:
+            self._wake()
+
+    def put_nowait(self,item):
+        return self.put(item,False)
+
+    def get(self,block=True,timeout=None):
+        """ Removes and returns the oldest item. If the queue is empty, waits
+        for the producer (up to timeout seconds) unless block is False.
+
+        Raises queue.Empty if nothing became available.
+        """
+        head = self._head
+        if self._tail == head:
+            if not block or not self._wait(lambda: self._tail != head,timeout,
+                    '_get_waiting'):
+                raise Empty
+        i = head & self._mask
+        item = self._slots[i]
+        self._slots[i] = None
+        self._head = head + 1 # frees the slot
+        if self._put_waiting:
+            self._wake()
+        return item
+
+    def get_nowait(self):
+        return self.get(False)
+
+    def drain(self,max_n=None,block=True,timeout=None):
+        """ Removes and returns up to max_n of the oldest items as a list,
+        waiting for at least one item as in get().
+
+        Raises queue.Empty if nothing became available.
+        """
+        head = self._head
+        if self._tail == head:
+            if not block or not self._wait(lambda: self._tail != head,timeout,
+                    '_get_waiting'):
+                raise Empty
+        n = self._tail - head
+        if max_n is not None:
+            n = min(max_n,n)
+        slots,mask = self._slots,self._mask
+        batch = []
+        for i in range(head,head + n):
+            batch.append(slots[i & mask])
+            slots[i & mask] = None
+        self._head = head + n
+        if self._put_waiting:
+            self._wake()
+        return batch
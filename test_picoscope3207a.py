@@ -0,0 +1,212 @@
+"""
+Picoscope3207a Smoke Test.
+
+This file runs Picoscope3207a end to end without a picoscope: windll is
+replaced by a fake ps3000a library whose functions are real ctypes callbacks
+built from API_ARGTYPES, so every driver call made by the class goes through
+ctypes argument conversion just as it would against lib\\ps3000a.dll. The fake
+captures a known ramp on each channel, which lets the saved run be checked
+after a round trip through raw_to_csv.
+
+Usage:
+    python -m unittest test_picoscope3207a
+"""
+
+import glob
+import os
+import tempfile
+import time
+import unittest
+import numpy as np
+
+from ctypes import *
+from unittest import mock
+
+import picoscope3207a
+from picoscope3207a import API_ARGTYPES,CALLBACK_FACTORY,Picoscope3207a
+from raw_to_csv import raw_to_csv
+
+# Module-level variables
+WAIT_TIMEOUT = 5 # seconds to wait for the save side to write a run
+MEMORY_SAMPLES = 64 << 20 # samples of capture memory shared by the segments
+
+class FakePS3000a(object):
+    """ Stands in for the ps3000a library returned by windll.LoadLibrary.
+    Counts calls, keeps the buffers registered per (channel, segment), and
+    fills them with ramp(channel) on GetValues. """
+
+    def __init__(self):
+        self.memory_samples = MEMORY_SAMPLES
+        self.stop_status = 0 # PICO_OK
+        self.calls = {}
+        self.buffers = {}
+        self._callbacks = [] # keeps the ctypes callbacks alive
+        for name,argtypes in API_ARGTYPES.items():
+            impl = getattr(self,"_" + name[len("ps3000a"):],None)
+            func = CALLBACK_FACTORY(c_uint32,*argtypes)(self._counted(name,impl))
+            self._callbacks.append(func)
+            setattr(self,name,func)
+
+    @staticmethod
+    def ramp(channel,samples):
+        return (np.arange(samples) + 1000*channel).astype(np.int16)
+
+    def _counted(self,name,impl):
+        def call(*args):
+            self.calls[name] = self.calls.get(name,0) + 1
+            return impl(*args) if impl is not None else 0
+        return call
+
+    def _OpenUnit(self,p_handle,serial):
+        p_handle[0] = 1
+        return 0
+
+    def _MemorySegments(self,handle,n_segments,p_max_samples):
+        p_max_samples[0] = self.memory_samples // n_segments
+        return 0
+
+    def _SetDataBuffer(self,handle,channel,buffer,n,segment,mode):
+        self.buffers[(channel,segment)] = (buffer,n)
+        return 0
+
+    def _RunBlock(self,handle,pre,post,timebase,oversample,p_time_ms,
+                  segment,ready,parameter):
+        ready(handle,0,None) # block captured at once
+        return 0
+
+    def _Stop(self,handle):
+        return self.stop_status
+
+    def _GetValues(self,handle,start,p_n,ratio,mode,segment,p_overflow):
+        for (channel,seg),(buffer,n) in self.buffers.items():
+            if seg == segment:
+                np.ctypeslib.as_array(buffer,shape=(n,))[:] = self.ramp(channel,n)
+        return 0
+
+    def _GetTriggerTimeOffset64(self,handle,p_time,p_units,segment):
+        p_time[0] = 0
+        return 0
+
+class FakeWindll(object):
+    """ windll replacement that loads FakePS3000a. """
+
+    def __init__(self,lib):
+        self._lib = lib
+
+    def LoadLibrary(self,path):
+        return self._lib
+
+def wait_for(condition,timeout=WAIT_TIMEOUT):
+    """ Polls condition() until it is true or timeout seconds pass. """
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+class PicoscopeSmokeTest(unittest.TestCase):
+
+    def setUp(self):
+        self._cwd = os.getcwd()
+        self._tmp = tempfile.TemporaryDirectory()
+        os.chdir(self._tmp.name) # runs are saved under the working directory
+        os.mkdir("data") # "data\\" is a directory on Windows, a prefix elsewhere
+        self.lib = FakePS3000a()
+        patcher = mock.patch.object(picoscope3207a,"windll",
+            FakeWindll(self.lib),create=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.pico = Picoscope3207a()
+
+    def tearDown(self):
+        self.pico.close()
+        os.chdir(self._cwd)
+        self._tmp.cleanup()
+
+    def sidecars(self):
+        return glob.glob("*.json") + glob.glob(os.path.join("data","*.json"))
+
+    def test_open_start_run_once_stop_close(self):
+        pico = self.pico
+        pico.open()
+        self.assertTrue(pico.ready)
+        pico.start()
+        # Let run_loop take its first block; the next is LOOP_TIME away
+        self.assertTrue(wait_for(lambda: self.lib.calls.get("ps3000aGetValues")))
+        n = self.lib.calls["ps3000aGetValues"]
+        pico.run_once()
+        self.assertEqual(self.lib.calls["ps3000aGetValues"],n + 1)
+        np.testing.assert_allclose(pico.channel_data[1],
+            self.lib.ramp(1,pico._samples)*pico._scale_f,rtol=1e-6)
+        pico.stop()
+        self.assertEqual(self.lib.calls["ps3000aStop"],1)
+        pico.run_once() # still captures while stopped
+        self.assertEqual(self.lib.calls["ps3000aGetValues"],n + 2)
+        pico.close()
+        self.assertFalse(pico.ready)
+        self.assertEqual(self.lib.calls["ps3000aCloseUnit"],1)
+
+    def test_start_fails_if_segments_too_small(self):
+        pico = self.pico
+        pico.open()
+        self.lib.memory_samples = picoscope3207a.RING_SLOTS*pico._samples - 1
+        pico.start()
+        self.assertFalse(pico.ready)
+        self.assertNotIn("ps3000aSetDataBuffer",self.lib.calls)
+        ring = pico._ring_shm
+        self.lib.memory_samples = MEMORY_SAMPLES
+        pico.start() # retried start reuses the frame ring
+        self.assertTrue(wait_for(lambda: pico.ready))
+        self.assertIs(pico._ring_shm,ring)
+
+    def test_raw_save_round_trip(self):
+        pico = self.pico
+        pico.open()
+        pico.start()
+        pico.run_once() # saved even though not collecting
+        pico.stop()     # flushes and closes the run's files
+        self.assertTrue(wait_for(lambda: self.sidecars()))
+        sidecar = self.sidecars()[0]
+        data = sidecar[:-len(".json")] + ".bin"
+        block_bytes = 2*pico._samples*2
+        self.assertTrue(wait_for(lambda: os.path.getsize(data) >= block_bytes))
+
+        n_blocks = raw_to_csv(sidecar,"run.csv")
+        self.assertGreaterEqual(n_blocks,1)
+        rows = np.loadtxt("run.csv",delimiter=',',skiprows=1)
+        self.assertEqual(rows.shape,(n_blocks*pico._samples,3))
+        np.testing.assert_allclose(rows[:pico._samples,0],pico._time_template,
+            rtol=1e-6,atol=1e-12)
+        for channel in range(2):
+            np.testing.assert_allclose(rows[:pico._samples,channel+1],
+                self.lib.ramp(channel,pico._samples)*pico._scale_f,rtol=1e-6)
+
+    def test_failed_stop_still_closes_run(self):
+        pico = self.pico
+        pico.open()
+        pico.start()
+        pico.run_once()
+        self.lib.stop_status = 0x3 # PICO_NOT_FOUND
+        with self.assertRaises(IOError):
+            pico.stop()
+        self.assertTrue(wait_for(lambda: self.sidecars()))
+        data = self.sidecars()[0][:-len(".json")] + ".bin"
+        block_bytes = 2*pico._samples*2
+        self.assertTrue(wait_for(lambda: os.path.getsize(data) == block_bytes))
+
+    def test_runs_in_same_second_get_own_files(self):
+        pico = self.pico
+        pico.open()
+        for run in range(2):
+            pico.start()
+            pico.run_once()
+            pico.stop()
+            self.assertTrue(wait_for(lambda: len(self.sidecars()) == run + 1))
+        block_bytes = 2*pico._samples*2
+        for sidecar in self.sidecars():
+            data = sidecar[:-len(".json")] + ".bin"
+            self.assertTrue(wait_for(lambda: os.path.getsize(data) == block_bytes))
+
+if __name__ == "__main__":
+    unittest.main()
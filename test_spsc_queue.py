@@ -0,0 +1,62 @@
+"""
+SPSCQueue Test.
+
+This file checks the single-producer single-consumer queue: queue.Queue style
+Full/Empty behaviour, and that one producer thread and one consumer thread
+pass every item through a small ring in order, with the consumer using both
+get() and drain().
+
+Usage:
+    python -m unittest test_spsc_queue
+"""
+
+import unittest
+
+from queue import Empty,Full
+from threading import Thread
+
+from spsc_queue import SPSCQueue
+
+# Module-level variables
+N_ITEMS = 100000 # items passed between the threads
+TIMEOUT = 10     # seconds before a stuck thread fails the test
+
+class SPSCQueueTest(unittest.TestCase):
+
+    def test_full_and_empty(self):
+        queue = SPSCQueue(2)
+        self.assertRaises(Empty,queue.get_nowait)
+        queue.put_nowait(1)
+        queue.put_nowait(2)
+        self.assertTrue(queue.full())
+        self.assertRaises(Full,queue.put_nowait,3)
+        self.assertRaises(Full,queue.put,3,timeout=0.01)
+        self.assertEqual(queue.drain(),[1,2])
+        self.assertRaises(Empty,queue.get,timeout=0.01)
+
+    def producer_consumer(self,consume):
+        queue = SPSCQueue(8)
+        received = []
+
+        def produce():
+            for i in range(N_ITEMS):
+                queue.put(i,timeout=TIMEOUT)
+
+        producer = Thread(target=produce)
+        producer.daemon = True
+        producer.start()
+        while len(received) < N_ITEMS:
+            received.extend(consume(queue))
+        producer.join(TIMEOUT)
+        self.assertFalse(producer.is_alive())
+        self.assertEqual(received,list(range(N_ITEMS)))
+        self.assertTrue(queue.empty())
+
+    def test_get(self):
+        self.producer_consumer(lambda queue: [queue.get(timeout=TIMEOUT)])
+
+    def test_drain(self):
+        self.producer_consumer(lambda queue: queue.drain(5,timeout=TIMEOUT))
+
+if __name__ == "__main__":
+    unittest.main()